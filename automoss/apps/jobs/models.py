@@ -90,6 +90,10 @@ class Job(models.Model):
     # Date and time job was completed
     completion_date = models.DateTimeField(null=True, blank=True)
 
+    # Token of the currently scheduled retry (claimed by the retried task)
+    retry_token = models.CharField(
+        max_length=UUID_LENGTH, null=True, blank=True, default=None)
+
     def __str__(self):
         """ Model to string method """
         return f"{self.comment} ({self.job_id})"
@@ -2,6 +2,8 @@
 from ..results.models import MOSSResult, Match
 from .models import Job, Submission, JobEvent
 from django.utils.timezone import now
+from django.db import transaction, connection
+from datetime import timedelta
 from ..moss.pinger import Pinger, LoadStatus
 from ..moss.moss import (
     MOSS,
@@ -44,11 +46,14 @@ from ...settings import (
 
     HOSTNAME
 )
-from ..utils.core import retry
+from ..utils.core import get_retry_delay
 import os
 import json
-import time
 import socket
+import atexit
+import uuid
+import threading
+from queue import Queue, Empty
 from ...celery import app
 from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
@@ -57,6 +62,143 @@ subject_template = "jobs/email/job-status-subject.txt"
 body_template = "jobs/email/job-status.txt"
 html_template = "jobs/email/job-status.html"
 
+# Maximum number of matches inserted per query
+MATCH_BATCH_SIZE = 500
+
+# Submission types, with the (relative) directory their files are uploaded to
+SUBMISSION_TYPE_DIRS = tuple((file_type, f'{os.sep}{file_type}')
+                             for file_type in SUBMISSION_TYPES)
+
+# Number of submissions fetched at a time
+SUBMISSION_CHUNK_SIZE = 2000
+
+# Maximum number of job events inserted per query
+EVENT_BATCH_SIZE = 200
+
+# Seconds to wait for more job events before writing
+EVENT_FLUSH_INTERVAL = 0.25
+
+# Job log (debugging), opened by the worker on first use and line-buffered
+JOBS_LOG_FILE = None
+JOBS_LOG_LOCK = threading.Lock()
+
+
+class JobEventWriter:
+    """Writes job events to the database in bulk, from a background thread.
+
+    Events are written once EVENT_BATCH_SIZE events have been logged, or
+    no other events were logged within EVENT_FLUSH_INTERVAL seconds.
+
+    The background thread uses its own database connection, which is closed
+    when the writer is closed. This costs a connection per job, which is not
+    reused like the worker's own connection (see CONN_MAX_AGE), but the job
+    never waits on the database to log an event.
+
+    If created inside a transaction (e.g., when testing), the background
+    thread would not be able to see uncommitted rows, so events are instead
+    written by the calling thread when flushing. Hence, process_job only uses
+    the background thread outside of TestCase (see TestJobEventWriter).
+
+    Errors which occur while writing are raised when flushing (or closing).
+    """
+
+    def __init__(self):
+        self.queue = Queue()
+        self.thread = None
+        self.pending = []
+        self.error = None  # First error of the background thread
+
+        if not connection.in_atomic_block:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.close()
+        except Exception as e:
+            if exc_type is None:
+                raise
+            # Do not hide the exception which is already being raised
+            logger.error(f'Unable to write job events: {e}')
+
+    def log(self, event):
+        """Queue an event to be written (never blocks on the database)"""
+        if self.thread is None:
+            self.pending.append(event)
+        else:
+            self.queue.put(event)
+
+    def flush(self):
+        """Wait until all queued events have been written"""
+        if self.thread is None:
+            events, self.pending = self.pending, []
+            self._write(events)
+        else:
+            self.queue.join()
+            self._raise_error()
+
+    def close(self):
+        """Write all queued events and stop the background thread"""
+        if self.thread is None:
+            self.flush()
+        else:
+            self.queue.put(None)
+            self.thread.join()
+            self._raise_error()
+
+    def _raise_error(self):
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _write(self, events):
+        JobEvent.objects.bulk_create(events, batch_size=EVENT_BATCH_SIZE)
+
+    def _run(self):
+        try:
+            while True:
+                event = self.queue.get()  # Wait for the next event
+                events = []
+                while event is not None:
+                    events.append(event)
+                    if len(events) >= EVENT_BATCH_SIZE:
+                        break
+                    try:
+                        event = self.queue.get(timeout=EVENT_FLUSH_INTERVAL)
+                    except Empty:
+                        break
+
+                try:
+                    self._write(events)
+                except Exception as e:
+                    logger.error(f'Unable to write job events: {e}')
+                    if self.error is None:
+                        self.error = e  # Raised by the calling thread
+
+                # Mark written events (and the stop signal) as done
+                for _ in range(len(events) + (event is None)):
+                    self.queue.task_done()
+
+                if event is None:
+                    return
+        finally:
+            connection.close()  # Connection of this thread
+
+
+def write_job_log(log_info):
+    """Append a job's information to the job log"""
+    global JOBS_LOG_FILE
+    with JOBS_LOG_LOCK:
+        if JOBS_LOG_FILE is None:
+            JOBS_LOG_FILE = open('jobs.log', 'a', buffering=1)
+            atexit.register(JOBS_LOG_FILE.close)
+
+        json.dump(log_info, JOBS_LOG_FILE)
+        JOBS_LOG_FILE.write('\n')
+
 
 def send_email_notification(job):
     """ Sends job notification to all emails associated with a job """
@@ -75,122 +217,147 @@ def send_email_notification(job):
     )
 
 
-@app.task(name='Upload')
-def process_job(job_id):
-    """Process a job, given its ID"""
+# The result is unused (stored in the database).
+# Retries are limited by MAX_RETRY_DURATION instead of a maximum count.
+@app.task(bind=True, name='Upload', ignore_result=True, max_retries=None)
+def process_job(self, job_id, attempt=0, url=None, retry_token=None):
+    """Process a job, given its ID.
 
-    try:
-        job = Job.objects.get(job_id=job_id)
-    except Job.DoesNotExist:
-        return
+    Recoverable errors reschedule the task (with the next attempt number,
+    the last valid report url and a token identifying the retry), instead
+    of sleeping in the worker.
+    """
 
-    if job.status != INQUEUE_STATUS:
+    # Prevents jobs from being processed more than once.
+    # Necessary because redis and celery store their own caches/lists
+    # of jobs, which may cause process_job to be run more than once.
+    # The job is claimed with a single (atomic) update, so that
+    # concurrent workers cannot both process it.
+    if attempt == 0:
         # A job will only be started if it is in the queue.
-        # Prevents jobs from being processed more than once.
-        # Necessary because redis and celery store their own caches/lists
-        # of jobs, which may cause process_job to be run more than once.
+        # Clears the token of any retry scheduled before the job was requeued.
+        claimed = Job.objects.filter(job_id=job_id, status=INQUEUE_STATUS).update(
+            status=UPLOADING_STATUS, start_date=now(), retry_token=None)
+    else:
+        # A retry will only be run if it is the one currently scheduled.
+        # The token is cleared when claimed, so duplicates are ignored.
+        claimed = retry_token is not None and Job.objects.filter(
+            job_id=job_id,
+            status__in=(UPLOADING_STATUS, PROCESSING_STATUS, PARSING_STATUS),
+            retry_token=retry_token
+        ).update(retry_token=None)
+
+    if not claimed:
         return
 
-    job.start_date = now()
-    msg = f'Starting job {job_id} with status {job.status}'
-    logger.info(msg)
-    JobEvent.objects.create(job=job, type=INQUEUE_EVENT, message=msg)
-    job.save()
-
-    base_dir = JOB_UPLOAD_TEMPLATE.format(
-        user_id=job.user.user_id, job_id=job.job_id)
-
-    paths = {}
-
-    for file_type in SUBMISSION_TYPES:
-        path = os.path.join(base_dir, file_type)
-        if not os.path.isdir(path):
-            continue  # Ignore if none of these files were submitted
+    try:
+        job = Job.objects.select_related('user').get(job_id=job_id)
+    except Job.DoesNotExist:
+        return
 
-        paths[file_type] = []
-        for f in os.listdir(path):
-            file_path = os.path.join(path, f)
-            if os.path.getsize(file_path) > 0:
-                # Only add non-empty files
-                paths[file_type].append(file_path)
+    # Job events are written in bulk by a background thread, to avoid
+    # blocking (e.g., MOSS upload callbacks) on the database
+    with JobEventWriter() as events:
 
-    if not paths.get(FILES_NAME):
-        job.status = FAILED_STATUS
-        job.save()
+        def log_event(type, message):
+            events.log(JobEvent(job=job, type=type, message=message))
 
-        JobEvent.objects.create(
-            job=job, type=FAILED_EVENT, message='No files supplied')
+        if attempt == 0:
+            msg = f'Starting job {job_id} with status {INQUEUE_STATUS}'
+            logger.info(msg)
+            log_event(INQUEUE_EVENT, msg)
+
+        base_dir = JOB_UPLOAD_TEMPLATE.format(
+            user_id=job.user.user_id, job_id=job.job_id)
+
+        paths = {}
+        file_sizes = {}  # Maps file path to size
+
+        for file_type, file_type_dir in SUBMISSION_TYPE_DIRS:
+            path = base_dir + file_type_dir
+            try:
+                it = os.scandir(path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue  # Ignore if none of these files were submitted
+
+            paths[file_type] = []
+            with it:
+                for entry in it:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+
+                    size = entry.stat().st_size
+                    if size > 0:
+                        # Only add non-empty files
+                        paths[file_type].append(entry.path)
+                        file_sizes[entry.path] = size
+
+        if not paths.get(FILES_NAME):
+            job.status = FAILED_STATUS
+            job.completion_date = now()
+            Job.objects.filter(pk=job.pk).update(
+                status=job.status, completion_date=job.completion_date)
 
-        send_email_notification(job)
-        return None
+            log_event(FAILED_EVENT, 'No files supplied')
+            events.flush()
 
-    num_attempts = 0
-    url = None
-    result = None
-    error = None
+            send_email_notification(job)
+            return None
 
-    for attempt, time_to_sleep in retry(MIN_RETRY_TIME, MAX_RETRY_TIME, EXPONENTIAL_BACKOFF_BASE, MAX_RETRY_DURATION, FIRST_RETRY_INSTANT):
         num_attempts = attempt
+        report_matches = None
+        error = None
+
+        def on_upload_start():
+            job.status = UPLOADING_STATUS
+            job.save(update_fields=['status'])
+            log_event(UPLOADING_EVENT, 'Started uploading files to MOSS')
+
+        def on_upload_finish():
+            log_event(UPLOADING_EVENT, 'Finished uploading')
+
+        def on_processing_start():
+            job.status = PROCESSING_STATUS
+            job.save(update_fields=['status'])
+            log_event(PROCESSING_EVENT, 'MOSS started processing files')
+
+        def on_processing_finish():
+            log_event(PROCESSING_EVENT, 'MOSS finished processing')
+
+        moss_kwargs = dict(
+            user_id=job.user.moss_id,
+            language=SUPPORTED_LANGUAGES[job.language][1],
+            **paths,
+            max_until_ignored=job.max_until_ignored,
+            max_displayed_matches=job.max_displayed_matches,
+            use_basename=True,
+
+            # TODO other events to log?
+            # on_start=None,
+            # on_connect=None,
+
+            on_upload_start=on_upload_start,
+            on_upload_finish=on_upload_finish,
+
+            on_processing_start=on_processing_start,
+            on_processing_finish=on_processing_finish,
+        )
 
         try:
-            error = None  # Reset error
             if not is_valid_moss_url(url):
                 # Keep retrying until valid url has been generated
                 # Do not restart whole job if this succeeds but parsing fails
-
-                def on_upload_start():
-                    job.status = UPLOADING_STATUS
-                    job.save()
-                    JobEvent.objects.create(
-                        job=job, type=UPLOADING_EVENT, message='Started uploading files to MOSS')
-
-                def on_upload_finish():
-                    JobEvent.objects.create(
-                        job=job, type=UPLOADING_EVENT, message='Finished uploading')
-
-                def on_processing_start():
-                    job.status = PROCESSING_STATUS
-                    job.save()
-                    JobEvent.objects.create(
-                        job=job, type=PROCESSING_EVENT, message='MOSS started processing files')
-
-                def on_processing_finish():
-                    JobEvent.objects.create(
-                        job=job, type=PROCESSING_EVENT, message='MOSS finished processing')
-
-                url = MOSS.generate_url(
-                    user_id=job.user.moss_id,
-                    language=SUPPORTED_LANGUAGES[job.language][1],
-                    **paths,
-                    max_until_ignored=job.max_until_ignored,
-                    max_displayed_matches=job.max_displayed_matches,
-                    use_basename=True,
-
-                    # TODO other events to log?
-                    # on_start=None,
-                    # on_connect=None,
-
-                    on_upload_start=on_upload_start,
-                    on_upload_finish=on_upload_finish,
-
-                    on_processing_start=on_processing_start,
-                    on_processing_finish=on_processing_finish,
-                )
+                url = MOSS.generate_url(**moss_kwargs)
 
             msg = f'Started parsing MOSS report: {url}'
             logger.info(msg)
 
             job.status = PARSING_STATUS
-            job.save()
-            JobEvent.objects.create(job=job, type=PARSING_EVENT, message=msg)
-
-            # Parsing and extraction
-            result = MOSS.generate_report(url)
-            msg = f'Result finished parsing: {len(result.matches)} matches detected'
-            logger.info(msg)
-            JobEvent.objects.create(job=job, type=PARSING_EVENT, message=msg)
+            job.save(update_fields=['status'])
+            log_event(PARSING_EVENT, msg)
 
-            break  # Success, do not retry
+            # Download report (matches are parsed while being stored below)
+            report_matches = MOSS.iter_matches(url)
 
         except socket.error as e:
             error = MossConnectionError(e.strerror or e)
@@ -233,98 +400,140 @@ def process_job(job_id):
         except FatalMossException as e:
             error = e
             logger.error(f'Fatal moss exception: {e}')
-            break  # Will be handled below (result is None)
+            # Will be handled below (report_matches is None)
 
         except Exception as e:
             error = e
             # Something catastrophic happened
             logger.error(f'Unknown error: {e}')
-            break  # Will be handled below (result is None)
-
-        msg = f'(Attempt {attempt + 1}) Error: {error} | Retrying in {round(time_to_sleep, 2)} seconds'
-
-
-        # We can retry
-        logger.warning(msg)
-        JobEvent.objects.create(job=job, type=RETRY_EVENT, message=msg)
+            # Will be handled below (report_matches is None)
+
+        retry_deadline = job.start_date + timedelta(seconds=MAX_RETRY_DURATION)
+        if isinstance(error, RecoverableMossException) and now() < retry_deadline:
+            # We can retry
+            time_to_sleep = get_retry_delay(
+                attempt, MIN_RETRY_TIME, MAX_RETRY_TIME, EXPONENTIAL_BACKOFF_BASE, FIRST_RETRY_INSTANT)
+
+            msg = f'(Attempt {attempt + 1}) Error: {error} | Retrying in {round(time_to_sleep, 2)} seconds'
+            logger.warning(msg)
+            log_event(RETRY_EVENT, msg)
+
+            # Make events visible while waiting to retry
+            events.flush()
+
+            # Reschedule the job, freeing up the worker in the meantime
+            retry_token = str(uuid.uuid4())
+            Job.objects.filter(pk=job.pk).update(retry_token=retry_token)
+            raise self.retry(
+                args=(job_id,),
+                kwargs={
+                    'attempt': attempt + 1,
+                    'url': url,
+                    'retry_token': retry_token
+                },
+                countdown=time_to_sleep
+            )
+
+        failed = report_matches is None
+
+        # Represents when no more processing of the job will occur
+        job.completion_date = now()
 
-        time.sleep(time_to_sleep)
-
-    failed = result is None
-
-    # Represents when no more processing of the job will occur
-    job.completion_date = now()
+        try:
+            if failed:
+                job.status = FAILED_STATUS
+                if error is not None:
+                    error_message = f'Error: {error}'
+                else:
+                    error_message = 'Maximum processing time exceeded (job has been cancelled)'
+
+                log_event(FAILED_EVENT, error_message)
+                events.flush()
+                send_email_notification(job)
+                return None
+
+            # Fetch all submissions of the job at once (avoids 2 queries per match).
+            # Only the columns needed to reference them are selected.
+            submissions = {
+                s.submission_id: s
+                for s in Submission.objects.filter(job=job).only('id', 'submission_id').iterator(chunk_size=SUBMISSION_CHUNK_SIZE)
+            }
+
+            # Matches are parsed while being stored (in batches), so only a batch of
+            # them is kept in memory at a time. The pages of the report have all been
+            # downloaded already, but each is released once parsed. The transaction
+            # is therefore held open while parsing, so that a partially stored
+            # result is never visible.
+            with transaction.atomic():
+                moss_result = MOSSResult.objects.create(
+                    job=job,
+                    url=url
+                )
 
-    try:
-        if failed:
-            job.status = FAILED_STATUS
-            if error is not None:
-                error_message = f'Error: {error}'
-            else:
-                error_message = 'Maximum processing time exceeded (job has been cancelled)'
+                num_matches = 0
+                matches = []
+                for match in report_matches:
+                    num_matches += 1
+                    first_submission = submissions.get(match.name_1)
+                    second_submission = submissions.get(match.name_2)
+
+                    # Ensure matching submission is found (avoid future errors)
+                    if first_submission and second_submission:
+                        matches.append((
+                            moss_result.id,
+                            first_submission.id,
+                            second_submission.id,
+                            match.percentage_1,
+                            match.percentage_2,
+                            match.lines_matched,
+                            match.line_matches
+                        ))
+
+                    # Insert matches in batches, as they are parsed
+                    if len(matches) >= MATCH_BATCH_SIZE:
+                        Match.objects.bulk_insert(matches)
+                        matches = []
+
+                Match.objects.bulk_insert(matches)
+
+            msg = f'Result finished parsing: {num_matches} matches detected'
+            logger.info(msg)
+            log_event(PARSING_EVENT, msg)
 
-            JobEvent.objects.create(
-                job=job, type=FAILED_EVENT, message=error_message)
+            log_event(COMPLETED_EVENT, 'Completed')
+            events.flush()
+            job.status = COMPLETED_STATUS
             send_email_notification(job)
-            return None
-
-        # Parse result
-        moss_result = MOSSResult.objects.create(
-            job=job,
-            url=result.url
-        )
-
-        for match in result.matches:
-            first_submission = Submission.objects.filter(
-                job=job, submission_id=match.name_1).first()
-            second_submission = Submission.objects.filter(
-                job=job, submission_id=match.name_2).first()
-
-            # Ensure matching submission is found (avoid future errors)
-            if first_submission and second_submission:
-                Match.objects.create(
-                    moss_result=moss_result,
-                    first_submission=first_submission,
-                    second_submission=second_submission,
-                    first_percentage=match.percentage_1,
-                    second_percentage=match.percentage_2,
-                    lines_matched=match.lines_matched,
-                    line_matches=match.line_matches
-                )
 
-        JobEvent.objects.create(
-            job=job, type=COMPLETED_EVENT, message='Completed')
-        job.status = COMPLETED_STATUS
-        send_email_notification(job)
-
-        return result.url
-
-    finally:
-        job.save()
-
-        if DEBUG:
-            # Calculate average file_size
-            num_files = len(paths[FILES_NAME])
-            avg_file_size = sum([os.path.getsize(x)
-                                for x in paths[FILES_NAME]]) / num_files
-
-            log_info = vars(job).copy()
-            log_info.pop('_state', None)
-            log_info.update({
-                'num_files': num_files,
-                'avg_file_size': avg_file_size,
-                'moss_id': job.user.moss_id,
-                'num_attempts': num_attempts
-            })
-
-            # Perform a ping
-            Pinger.ping()
-
-            log_info.update({'avg': Pinger.get_average_ping()} or {})
-            logger.debug(f'Job info: {log_info}')
-
-            with open('jobs.log', 'a+') as fp:
-                log_info['duration'] = (
-                    log_info['completion_date'] - log_info['start_date']).total_seconds()
-                json.dump(log_info, fp, sort_keys=True, default=str)
-                print(file=fp)
+            return url
+
+        finally:
+            job.save(update_fields=['status', 'completion_date'])
+
+            if DEBUG:
+                # Calculate average file_size
+                num_files = len(paths[FILES_NAME])
+                avg_file_size = sum(
+                    file_sizes[x] for x in paths[FILES_NAME]) / num_files
+
+                # Perform a ping
+                Pinger.ping()
+
+                log_info = {
+                    'job_id': str(job.job_id),
+                    'status': job.status,
+                    'language': job.language,
+                    'max_until_ignored': job.max_until_ignored,
+                    'max_displayed_matches': job.max_displayed_matches,
+                    'start_date': job.start_date.isoformat(),
+                    'completion_date': job.completion_date.isoformat(),
+                    'duration': (job.completion_date - job.start_date).total_seconds(),
+                    'num_files': num_files,
+                    'avg_file_size': avg_file_size,
+                    'moss_id': job.user.moss_id,
+                    'num_attempts': num_attempts,
+                    'avg': Pinger.get_average_ping()
+                }
+                logger.debug(f'Job info: {log_info}')
+
+                write_job_log(log_info)
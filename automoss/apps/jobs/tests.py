@@ -1,17 +1,23 @@
 from ..users.tests import AuthenticatedUserTest
 from ...settings import (
     COMPLETED_STATUS,
-    TESTS_ROOT
+    INQUEUE_EVENT,
+    TESTS_ROOT,
+    JOB_UPLOAD_TEMPLATE,
+    FILES_NAME
 )
-from .tasks import process_job
-from .models import Job
-from ..results.models import Match
+from .tasks import process_job, JobEventWriter, EVENT_BATCH_SIZE
+from .models import Job, JobEvent, Submission
+from ..results.models import Match, MOSSResult
 from django.utils.timezone import now
 from django.http.response import HttpResponse
 from django.urls import reverse
+from django.test import TransactionTestCase
 from django.contrib.auth import get_user_model
 import os
 import zipfile
+from unittest.mock import patch
+from celery.exceptions import Retry
 from automoss.apps.moss.moss import (
     MOSS,
     RecoverableMossException,
@@ -46,7 +52,10 @@ class TestJobs(AuthenticatedUserTest):
         if not job_id:
             return
 
-        process_job(job_id)
+        # Run eagerly. Retries would also be executed immediately (ignoring
+        # their countdown), so the job is not rescheduled if MOSS fails.
+        with patch.object(process_job, 'retry', return_value=Retry()):
+            process_job.apply(args=(job_id,))
 
         self.assertTrue(isinstance(submit_response, HttpResponse))
 
@@ -177,6 +186,10 @@ class TestAPI(AuthenticatedUserTest):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(isinstance(response, HttpResponse))
 
+        job, = response.json()
+        self.assertEqual(job['job_id'], str(self.test_job.job_id))
+        self.assertNotIn('retry_token', job)
+
     def test_get_statuses(self):
         """Test API for getting statuses of a user's jobs"""
 
@@ -211,3 +224,148 @@ class TestResults(AuthenticatedUserTest):
             reverse("jobs:results:index", kwargs={"job_id": self.test_job.job_id}))
         self.assertEqual(report_response.status_code, 200)
         self.assertTrue(isinstance(report_response, HttpResponse))
+
+
+class TestJobRetries(AuthenticatedUserTest):
+    """ Test case to test rescheduling of jobs """
+
+    def setUp(self):
+        super().setUp()
+        self.job = Job.objects.create(user=self.user)
+
+        files_dir = os.path.join(JOB_UPLOAD_TEMPLATE.format(
+            user_id=self.user.user_id, job_id=self.job.job_id), FILES_NAME)
+        os.makedirs(files_dir)
+        with open(os.path.join(files_dir, 'file.py'), 'w') as fp:
+            fp.write('print(1)\n')
+
+    def tearDown(self):
+        self.job.delete()
+
+    def test_duplicate_retry(self):
+        """Test that a retry which is delivered twice only runs once"""
+
+        retries = []
+
+        def on_retry(**kwargs):
+            retries.append(kwargs)
+            return Retry()
+
+        def generate_url(**kwargs):
+            if not retries:
+                raise RecoverableMossException('Test')
+            return 'http://moss.stanford.edu/results/0/1234567890'
+
+        with patch.object(MOSS, 'generate_url', generate_url), \
+                patch.object(MOSS, 'iter_matches', lambda url: iter([])), \
+                patch.object(process_job, 'retry', side_effect=on_retry), \
+                patch('automoss.apps.jobs.tasks.send_email_notification'):
+
+            process_job.apply(args=(self.job.job_id,))
+            self.assertEqual(len(retries), 1)
+
+            # Deliver the scheduled retry twice
+            for _ in range(2):
+                process_job.apply(
+                    args=retries[0]['args'], kwargs=retries[0]['kwargs'])
+
+        self.assertEqual(len(retries), 1)
+        self.assertEqual(MOSSResult.objects.filter(job=self.job).count(), 1)
+        self.assertEqual(Job.objects.get(
+            pk=self.job.pk).status, COMPLETED_STATUS)
+
+
+class TestJobEventWriter(TransactionTestCase):
+    """ Test case to test writing job events from a background thread """
+
+    def setUp(self):
+        user = User.objects.create_user(
+            course_code='user', primary_email_address='test@localhost', moss_id=1)
+        self.job = Job.objects.create(user=user)
+
+    def _get_messages(self):
+        return list(JobEvent.objects.filter(job=self.job).order_by(
+            'id').values_list('message', flat=True))
+
+    def test_write_events(self):
+        """Test that events are written in order, over multiple batches"""
+
+        messages = [str(i) for i in range(2 * EVENT_BATCH_SIZE + 1)]
+
+        writer = JobEventWriter()
+        self.assertIsNotNone(writer.thread)  # Not in a transaction
+
+        for message in messages:
+            writer.log(JobEvent(job=self.job, type=INQUEUE_EVENT, message=message))
+
+        writer.flush()
+        self.assertEqual(self._get_messages(), messages)
+
+        writer.log(JobEvent(job=self.job, type=INQUEUE_EVENT, message='last'))
+        writer.close()
+        self.assertFalse(writer.thread.is_alive())
+        self.assertEqual(self._get_messages(), messages + ['last'])
+
+    def test_write_error(self):
+        """Test that errors of the background thread are raised when flushing"""
+
+        with JobEventWriter() as writer:
+            # Event of an unsaved job cannot be written
+            writer.log(JobEvent(job=Job(user=self.job.user),
+                       type=INQUEUE_EVENT, message='error'))
+
+            with self.assertRaises(ValueError):
+                writer.flush()
+
+            # Writer continues after an error
+            writer.log(JobEvent(job=self.job, type=INQUEUE_EVENT, message='ok'))
+            writer.flush()
+
+        self.assertEqual(self._get_messages(), ['ok'])
+
+
+class TestMatches(AuthenticatedUserTest):
+    """ Test case to test storing of matches """
+
+    def setUp(self):
+        super().setUp()
+        self.job = Job.objects.create(user=self.user)
+        self.submissions = [Submission.objects.create(
+            job=self.job, name=name, file_type=FILES_NAME) for name in 'abc']
+        self.moss_result = MOSSResult.objects.create(
+            job=self.job, url='http://moss.stanford.edu/results/0/1234567890')
+
+    def tearDown(self):
+        self.job.delete()
+
+    def test_bulk_insert(self):
+        """Test inserting matches and reading them back"""
+
+        line_matches = [
+            {'first': {'from': 1, 'to': 10}, 'second': {'from': 5, 'to': 14}},
+            {'first': {'from': 20, 'to': 25}, 'second': {'from': 30, 'to': 35}}
+        ]
+        first, second, third = self.submissions
+        rows = [
+            (self.moss_result.id, first.id, second.id, 90, 80, 16, line_matches),
+            (self.moss_result.id, first.id, third.id, 50, 40, 6, line_matches[:1]),
+            (self.moss_result.id, second.id, third.id, 10, 20, 0, [])
+        ]
+        Match.objects.bulk_insert(rows, batch_size=2)
+
+        matches = list(Match.objects.filter(
+            moss_result=self.moss_result).order_by('id'))
+        self.assertEqual([
+            (m.moss_result_id, m.first_submission_id, m.second_submission_id,
+             m.first_percentage, m.second_percentage, m.lines_matched, m.line_matches)
+            for m in matches
+        ], rows)
+
+        # Defaults are used for the other fields
+        match_ids = {m.match_id for m in matches}
+        self.assertEqual(len(match_ids), len(rows))
+        self.assertTrue(all(match_ids))
+
+        # Nothing is inserted without rows
+        Match.objects.bulk_insert([])
+        self.assertEqual(Match.objects.count(), len(rows))
@@ -46,6 +46,10 @@ from ...settings import (
 from ...celery import app
 from ..utils.core import in_range
 
+# Fields of jobs sent to clients (the retry token is only used internally)
+PUBLIC_JOB_FIELDS = [field for field in Job._meta.concrete_fields
+                     if field.name != 'retry_token']
+
 
 @register.filter(is_safe=True)
 def js(obj):
@@ -147,7 +151,8 @@ class New(View):
 
         process_job.delay(job_id)
 
-        data = json.loads(serialize('json', [new_job]))[0]['fields']
+        data = json.loads(serialize('json', [new_job], fields=[
+            field.name for field in PUBLIC_JOB_FIELDS]))[0]['fields']
         return JsonResponse(data, status=200, safe=False)
 
 
@@ -242,7 +247,8 @@ class JSONJobs(View):
 
     def get(self, request):
         """ Get user's jobs """
-        results = Job.objects.user_jobs(request.user).values()
+        results = Job.objects.user_jobs(request.user).values(
+            *(field.attname for field in PUBLIC_JOB_FIELDS))
         return JsonResponse(list(results), status=200, safe=False)
 
 
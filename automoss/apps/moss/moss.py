@@ -1,4 +1,3 @@
-from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 import socket
 import os
@@ -22,10 +21,13 @@ HTTP_RETRY_COUNT = 5
 
 ERROR_PREFIX = 'Error: '
 
+# Matches urls with the MOSS host (e.g., http://moss.stanford.edu/results/1/2345678)
+MOSS_URL_REGEX = re.compile(rf'^https?://{re.escape(MOSS_URL)}(?:[/?#]|$)')
+
 
 def is_valid_moss_url(url):
     """Determine if the url given is a valid url for a MOSS report (correct host)"""
-    return url and urlparse(url).netloc == MOSS_URL
+    return url is not None and MOSS_URL_REGEX.match(url) is not None
 
 
 class MossException(Exception):
@@ -327,14 +329,18 @@ class MossMatch:
 
 class Result:
 
-    def __init__(self, url):
+    def __init__(self, url, lazy=False):
         """Create a Result object from a MOSS URL
 
         :param url: The MOSS URL
         :type url: str
+        :param lazy: Whether to only parse matches while iterating over them, defaults to False
+        :type lazy: bool, optional
         """
         self.url = url
-        self.matches = list(self._parse_matches(url))
+        self.matches = self._parse_matches(self._download_matches(url))
+        if not lazy:
+            self.matches = list(self.matches)
 
     # https://stackoverflow.com/a/54878794
     async def _fetch(self, session, url):
@@ -356,7 +362,7 @@ class Result:
                      for u in urls]
             return [await result for result in asyncio.as_completed(tasks)]
 
-    def _parse_matches(self, url):
+    def _download_matches(self, url):
         base_url = f"{url.rstrip('/')}/"  # Ensure link ends with a /
         req = requests.get(base_url, verify=False)
         if req.status_code != 200:
@@ -369,9 +375,13 @@ class Result:
         num_matches = html.count('<TR>') - 1
 
         urls = [f'{base_url}match{i}-top.html' for i in range(num_matches)]
-        responses = asyncio.run(self._fetch_concurrent(urls))
+        return asyncio.run(self._fetch_concurrent(urls))
 
-        for response in responses:
+    def _parse_matches(self, responses):
+        # Remove each page from the (downloaded) list before parsing it, so
+        # that it can be freed once its match has been parsed
+        while responses:
+            response = responses.pop()
             try:
                 yield MossMatch(response)
             except UnparseableMatch:
@@ -405,14 +415,14 @@ class MOSS:
         return cls.generate_report(url)
 
     @classmethod
-    def generate_report(cls, url):
+    def generate_report(cls, url, lazy=False):
         """Generate a MOSS report, given a valid URL"""
 
         if not is_valid_moss_url(url):
             raise InvalidReportURL(f'Invalid report url: "{url}"')
 
         try:
-            return Result(url)
+            return Result(url, lazy)
 
         except ReportParsingError:
             raise
@@ -420,6 +430,13 @@ class MOSS:
         except Exception as e:
             raise ReportParsingError(f'Malformed Report: {url}. Error: {e}')
 
+    @classmethod
+    def iter_matches(cls, url):
+        """Download a MOSS report, given a valid URL, and return an iterator
+        which parses its matches one at a time (releasing each page once parsed)"""
+
+        return cls.generate_report(url, lazy=True).matches
+
     @classmethod
     def callback(cls, f, *args, **kwargs):
         """Run callback function"""
@@ -46,6 +46,15 @@ class TestMossAPI(TestCase):
 
         self.assertTrue(is_valid_moss_url(result.url))
 
+    def test_valid_url(self):
+        """Test validation of moss urls"""
+
+        self.assertTrue(is_valid_moss_url(
+            'http://moss.stanford.edu/results/0/1234567890'))
+
+        for url in (None, '', 'invalid_url', 'http://moss.stanford.edu.com/results/0/1234567890'):
+            self.assertFalse(is_valid_moss_url(url))
+
     def test_invalid(self):
         """Test invalid moss results"""
 
@@ -1,6 +1,5 @@
 
 # Helper methods
-import time
 import os
 import sys
 import inspect
@@ -71,18 +70,11 @@ def is_testing():
     return bool(os.environ.get('IS_TESTING'))
 
 
-def retry(min_time, max_time, base, max_retry_duration, first_instant):
-    """Helper method for retrying with a capped exponential backoff with max retry time"""
+def get_retry_delay(attempt_number, min_time, max_time, base, first_instant):
+    """Get the time to wait after an attempt, using a capped exponential backoff"""
 
-    attempt_number = 0
-    if first_instant:
-        yield attempt_number, 0
-        attempt_number += 1
+    if first_instant and attempt_number == 0:
+        return 0
 
-    start_time = time.time()
-    while time.time() < start_time + max_retry_duration:
-        time2 = min(max(base ** attempt_number, min_time),
-                   max_time)  # Current sleep time
+    return min(max(base ** attempt_number, min_time), max_time)
 
-        yield attempt_number, time2
-        attempt_number += 1
@@ -0,0 +1,21 @@
+from unittest import TestCase
+from .core import get_retry_delay
+
+
+class TestRetryDelay(TestCase):
+    """Test case to test the retry backoff"""
+
+    def test_first_instant(self):
+        """Test that only the first attempt is retried instantly"""
+
+        self.assertEqual(get_retry_delay(0, 30, 600, 2, True), 0)
+        self.assertEqual(get_retry_delay(1, 30, 600, 2, True), 30)
+
+    def test_backoff(self):
+        """Test that the delay grows exponentially, within its bounds"""
+
+        self.assertEqual(get_retry_delay(0, 30, 600, 2, False), 30)
+        self.assertEqual(get_retry_delay(4, 30, 600, 2, False), 30)
+        self.assertEqual(get_retry_delay(6, 30, 600, 2, False), 64)
+        self.assertEqual(get_retry_delay(9, 30, 600, 2, False), 512)
+        self.assertEqual(get_retry_delay(10, 30, 600, 2, False), 600)
@@ -109,7 +109,10 @@ if not is_testing():
         'HOST': os.getenv("DB_HOST"),
         'PORT': '3306',
         'USER': os.getenv("DB_USER"),
-        'PASSWORD': os.getenv("DB_PASSWORD")
+        'PASSWORD': os.getenv("DB_PASSWORD"),
+
+        # Keep connections open (per thread) between requests/tasks
+        'CONN_MAX_AGE': 600
     }
 else:
     default_database = {
@@ -193,6 +196,9 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Only reserve one task at a time, so long jobs do not block short ones
+CELERYD_PREFETCH_MULTIPLIER = 1
+
 # Default (None) is the number of CPUs available on your system.
 # TODO min(num processors, 4)
 CELERY_CONCURRENCY = 4  # None